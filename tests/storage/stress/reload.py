@@ -87,9 +87,14 @@ To run reload tests run:
 
 
 This runs one trial, which takes 80-90 minutes. Check the "Stats" logs to get
-reloads timings and errors stats.
+reloads timings and errors stats. Every reloader logs a line like:
 
-Here are (reformatted) results from CentOS 7.8 VM:
+    INFO    (MainThread) Stats for vgs: reloads=... errors=... error_rate=...%
+    failures=... avg_time=... med_time=... min_time=... max_time=...
+
+Here are (reformatted) results from CentOS 7.8 VM, using an older version of
+this script that ran every reloader in its own thread, and modified the vgs
+using one lvm command per lv:
 
     2020-05-30 01:26:25,346 INFO    (reload/vg) Stats:
     reloads=3455 errors=170 error_rate=4.92% avg_time=1.369 med_time=1.216
@@ -103,7 +108,7 @@ Here are (reformatted) results from CentOS 7.8 VM:
     reloads=4756 errors=205 error_rate=4.31% avg_time=0.990 med_time=0.925
     min_time=0.147 max_time=5.961
 
-Here results from Fedora 31:
+Here results from Fedora 31, using the same older version:
 
     2020-05-30 01:33:25,981 INFO    (reload/pv) Stats:
     reloads=3540 errors=0 error_rate=0.00% avg_time=1.558 med_time=1.510
@@ -131,14 +136,24 @@ To remove the storage run:
 # developers.
 
 import argparse
-import glob
+import array
+import asyncio
+import concurrent.futures
+import functools
+import json
 import logging
+import math
+import mmap
+import multiprocessing
 import os
 import random
+import shutil
 import signal
+import statistics
 import subprocess
 import threading
 import time
+import weakref
 
 # Based on vdsm configuration, adapted to use device mapper delay devices.
 #
@@ -175,7 +190,38 @@ REMOVED_IMAGE_PREFIX = "_remove_me_"
 
 VG_PREFIX = "bz1837199"
 
-terminated = threading.Event()
+# lvm exit code for failed commands.
+ECMD_FAILED = 5
+
+# Write 2 MiB per lv, total 10 GiB per 5000 lvs.
+IO_SIZE = 2 * 1024**2
+
+# Workers run in child processes so they do not contend on the GIL with
+# the reloaders. Use fork since we share module globals with the workers.
+mp = multiprocessing.get_context("fork")
+
+terminated = mp.Event()
+
+# Signal received by a worker process. The worker signal handler must not
+# touch the terminated event, since the interrupted worker may be waiting on
+# the event, and setting it from the handler would deadlock.
+worker_signal = None
+
+# Older losetup (e.g. RHEL 7.8) fails if another losetup attached the free
+# loop device it found, so we attach loop devices one at a time.
+losetup_lock = threading.Lock()
+
+# Per thread buffers for perform_io().
+io_buffers = threading.local()
+
+# Commands we need to terminate when terminating. The lock is reentrant since
+# workers terminate commands in a signal handler.
+running_commands = weakref.WeakSet()
+running_commands_lock = threading.RLock()
+
+# Reload commands are owned by the event loop, and must be terminated from
+# the event loop thread.
+running_async_commands = weakref.WeakSet()
 
 
 class Terminated(Exception):
@@ -218,6 +264,11 @@ def main():
         level=logging.DEBUG if args.debug else logging.INFO,
         format="%(asctime)s %(levelname)-7s (%(threadName)s) %(message)s")
 
+    # Commands inherit file descriptors inherited by this process (see
+    # executable()). lvm warns about them, and we treat any lvm message as an
+    # error.
+    os.environ["LVM_SUPPRESS_FD_WARNINGS"] = "1"
+
     globals()["cmd_" + args.command](args)
 
 
@@ -246,6 +297,13 @@ def parse_args():
         default=500,
         help="Number of lvs per vg")
 
+    p.add_argument(
+        "--batch-size",
+        type=positive_int,
+        default=50,
+        help="Number of lvs to modify in every worker step. Workers log "
+             "progress and check for termination between steps")
+
     p.add_argument(
         "--pv-size",
         type=gib,
@@ -277,6 +335,20 @@ def parse_args():
         action="store_false",
         help="Avoid using --select for reloading")
 
+    p.add_argument(
+        "--reload-concurrency",
+        type=positive_int,
+        default=1,
+        help="Number of concurrent pvs, vgs, and lvs commands (1)")
+
+    p.add_argument(
+        "--reload-batch",
+        type=positive_int,
+        default=1,
+        help="Number of random items to reload in a single pvs, vgs, or lvs "
+             "command. Reloading more than one item per command amortizes "
+             "lvm startup, but does not simulate vdsm flows (1)")
+
     p.add_argument(
         "--verbose",
         choices=(1, 2, 3, 4),
@@ -297,6 +369,12 @@ def parse_args():
         default=0,
         help="Max retries for a failing pvs/vgs/lvs commands")
 
+    p.add_argument(
+        "--pin-cpus",
+        action="store_true",
+        help="Run reloaders and workers on separate halves of the available "
+             "cpus (false)")
+
     p.add_argument(
         "--debug",
         action="store_true",
@@ -310,48 +388,64 @@ def cmd_setup(args):
 
     lvm = LVMRunner()
 
-    for i in range(args.vg_count):
-        # Create backing file.
-        backing_file = "backing_{:02}".format(i)
-        logging.info("Creating backing file %s", backing_file)
-        with open(backing_file, "w") as f:
-            f.truncate(args.pv_size)
-
-        # Create loop device.
+    # Devices are independent, so we can set them up concurrently.
+    run_parallel(
+        functools.partial(setup_vg, lvm, args),
+        range(args.vg_count),
+        "setup")
+
+
+def setup_vg(lvm, args, i):
+    # Create backing file.
+    backing_file = "backing_{:02}".format(i)
+    logging.info("Creating backing file %s", backing_file)
+    # Keep the file sparse; the pv is mostly empty.
+    fd = os.open(backing_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(fd, args.pv_size)
+    finally:
+        os.close(fd)
+
+    # Create loop device.
+    with losetup_lock:
         loop_device = run(["losetup", "--find", "--show", backing_file])
-        logging.info("Created loop device %s", loop_device)
-
-        # Create link to device so we can easily remove it later.
-        loop_link = "loop_{:02}".format(i)
-        logging.info("Creating symlink %s -> %s", loop_link, loop_device)
-        os.symlink(loop_device, loop_link)
-
-        # Create a delay device.
-        delay_name = make_delay_name(i)
-        logging.info("Creating delay device %s", delay_name)
-        sectors = int(run(["blockdev", "--getsize", loop_device]))
-        table = (
-            "0 {sectors} delay "
-            "{device} 0 {read_delay} "
-            "{device} 0 {write_delay}"
-        ).format(
-            sectors=sectors,
-            device=loop_device,
-            read_delay=args.read_delay_msec,
-            write_delay=args.write_delay_msec
-        )
-        run(["dmsetup", "create", delay_name], input=table.encode("utf-8"))
+    logging.info("Created loop device %s", loop_device)
+
+    # Create link to device so we can easily remove it later.
+    loop_link = "loop_{:02}".format(i)
+    logging.info("Creating symlink %s -> %s", loop_link, loop_device)
+    os.symlink(loop_device, loop_link)
+
+    # Create a delay device.
+    delay_name = make_delay_name(i)
+    logging.info("Creating delay device %s", delay_name)
+    sectors = int(run(["blockdev", "--getsize", loop_device]))
+    table = (
+        "0 {sectors} delay "
+        "{device} 0 {read_delay} "
+        "{device} 0 {write_delay}"
+    ).format(
+        sectors=sectors,
+        device=loop_device,
+        read_delay=args.read_delay_msec,
+        write_delay=args.write_delay_msec
+    )
+    run(["dmsetup", "create", delay_name], input=table.encode("utf-8"),
+        capture=False)
 
-        # Create link to device so we can easily remove it later.
-        pv_name = make_pv_name(i)
-        delay_link = "delay_{:02}".format(i)
-        logging.info("Creating symlink %s -> %s", delay_link, pv_name)
-        os.symlink(pv_name, delay_link)
+    # Create link to device so we can easily remove it later.
+    pv_name = make_pv_name(i)
+    delay_link = "delay_{:02}".format(i)
+    logging.info("Creating symlink %s -> %s", delay_link, pv_name)
+    os.symlink(pv_name, delay_link)
 
-        # Create a pv and vg.
+    # Create a pv and vg.
+    try:
         lvm.create_pv(pv_name)
         vg_name = make_vg_name(i)
         lvm.create_vg(vg_name, pv_name)
+    finally:
+        lvm.close()
 
 
 def cmd_teardown(args):
@@ -363,130 +457,244 @@ def cmd_teardown(args):
     logging.info("Deactivating lvs")
     lvm.run("vgchange", "--activate", "n", "--select",
             "vg_name =~ ^{}-[0-9]+".format(VG_PREFIX))
+    lvm.close()
+
+    with os.scandir(".") as it:
+        names = [entry.name for entry in it]
+
+    delay_links = [n for n in names if n.startswith("delay_")]
+    loop_links = [n for n in names if n.startswith("loop_")]
+    backing_files = [n for n in names if n.startswith("backing_")]
+
+    # Every step must complete before the next one, but the devices in each
+    # step can be removed concurrently.
+    run_parallel(remove_delay_device, delay_links, "teardown")
+    run_parallel(remove_loop_device, loop_links, "teardown")
+    run_parallel(remove_backing_file, backing_files, "teardown")
+
+
+def remove_delay_device(delay_link):
+    delay_device = os.readlink(delay_link)
 
-    # Wipe and remove the devices.
-    for delay_link in glob.glob("delay_*"):
-        delay_device = os.readlink(delay_link)
+    if os.path.exists(delay_device):
+        logging.info("Wiping delay device %s", delay_device)
+        run(["wipefs", "--all", delay_device], capture=False)
 
-        if os.path.exists(delay_device):
-            logging.info("Wiping delay device %s", delay_device)
-            run(["wipefs", "--all", delay_device])
+        delay_name = os.path.basename(delay_device)
+        logging.info("Removing delay device %s", delay_name)
+        run(["dmsetup", "remove", "--force", delay_name], capture=False)
 
-            delay_name = os.path.basename(delay_device)
-            logging.info("Removing delay device %s", delay_name)
-            run(["dmsetup", "remove", "--force", delay_name])
+    os.unlink(delay_link)
 
-        os.unlink(delay_link)
 
-    # Remove the loop devices.
-    for loop_link in glob.glob("loop_*"):
-        loop_device = os.readlink(loop_link)
+def remove_loop_device(loop_link):
+    loop_device = os.readlink(loop_link)
 
-        logging.info("Removing loop device %s", loop_device)
-        run(["losetup", "--detach", loop_device])
+    logging.info("Removing loop device %s", loop_device)
+    run(["losetup", "--detach", loop_device], capture=False)
 
-        os.unlink(loop_link)
+    os.unlink(loop_link)
 
-    # Remove the backing files.
-    for backing_file in glob.glob("backing_*"):
-        logging.info("Removing backing file %s", backing_file)
-        os.unlink(backing_file)
+
+def remove_backing_file(backing_file):
+    logging.info("Removing backing file %s", backing_file)
+    os.unlink(backing_file)
+
+
+def run_parallel(func, items, name):
+    """
+    Call func with every item in a thread pool, raising the first error.
+    """
+    items = list(items)
+    if not items:
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(items), thread_name_prefix=name) as executor:
+        for _ in executor.map(func, items):
+            pass
 
 
 def cmd_run(args):
     logging.info("Running trials args=%s", args)
 
-    register_termination_signals()
+    # Before python 3.8 asyncio can start subprocesses only from an event
+    # loop running in the main thread, so the main thread runs the reloaders
+    # and waits for the workers in the same event loop.
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(run_trials(args))
+        loop.run_until_complete(loop.shutdown_asyncgens())
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+async def run_trials(args):
+    loop = asyncio.get_event_loop()
+    workers = []
+
+    # Register the signals before starting the workers, so we terminate the
+    # workers if we get a signal while starting them.
+    for signo in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signo, terminate_run, signo, workers)
 
-    reloaders_lvm = LVMRunner(
-        use_udev=args.use_udev,
-        verbose=args.verbose,
-        read_only=args.read_only)
-    reloaders = []
-
-    logging.info("Starting pv reloader")
-    r = threading.Thread(
-        target=pv_reloader,
-        args=(reloaders_lvm, args),
-        daemon=True,
-        name="reload/pv",
-    )
-    r.start()
-    reloaders.append(r)
-
-    logging.info("Starting vg reloader")
-    r = threading.Thread(
-        target=vg_reloader,
-        args=(reloaders_lvm, args),
-        daemon=True,
-        name="reload/vg",
-    )
-    r.start()
-    reloaders.append(r)
-
-    logging.info("Starting lv reloader")
-    r = threading.Thread(
-        target=lv_reloader,
-        args=(reloaders_lvm, args),
-        daemon=True,
-        name="reload/lv",
-    )
-    r.start()
-    reloaders.append(r)
+    # Format the names once, instead of every time we use them.
+    pv_names = [make_pv_name(i) for i in range(args.vg_count)]
+    vg_names = [make_vg_name(i) for i in range(args.vg_count)]
+    lv_names = [make_lv_name(i) for i in range(args.lv_count)]
+
+    if args.pin_cpus:
+        reloaders_cpus, workers_cpus = split_cpus()
+        logging.info("Using cpus %s for reloaders and cpus %s for workers",
+                     sorted(reloaders_cpus), sorted(workers_cpus))
+    else:
+        reloaders_cpus = workers_cpus = None
 
     workers_lvm = LVMRunner()
-    workers = []
 
-    for i in range(args.vg_count):
-        vg_name = make_vg_name(i)
+    for i, vg_name in enumerate(vg_names):
+        # Mix workers flows by starting them with a random delay.
+        start_delay = random.uniform(0, args.vg_count)
 
-        logging.info("Starting worker for vg %s", vg_name)
-        w = threading.Thread(
+        logging.info("Starting worker for vg %s with delay %.3f",
+                     vg_name, start_delay)
+        w = mp.Process(
             target=worker,
-            args=(workers_lvm, args, vg_name),
+            args=(workers_lvm, args, vg_name, lv_names, start_delay,
+                  workers_cpus),
             daemon=True,
             name="worker/{:02}".format(i),
         )
         w.start()
         workers.append(w)
 
-        # Mix workers flows by starting them with a delay.
-        time.sleep(1)
+    # Start the reloaders after the workers, since forking a process with
+    # running threads is not safe.
+    if reloaders_cpus:
+        # Inherited by reload commands.
+        os.sched_setaffinity(0, reloaders_cpus)
+
+    reloaders_lvm = LVMRunner(
+        use_udev=args.use_udev,
+        verbose=args.verbose,
+        read_only=args.read_only)
+
+    logging.info("Starting reloaders")
+    reloaders = asyncio.ensure_future(
+        reload_all(reloaders_lvm, args, pv_names, vg_names, lv_names))
 
-    while workers:
-        workers[0].join(1.0)
-        if not workers[0].is_alive():
-            workers.pop(0)
+    await asyncio.gather(*(wait_for_worker(w) for w in workers))
 
     logging.info("Workers stopped")
 
     terminated.set()
 
-    while reloaders:
-        reloaders[0].join(1.0)
-        if not reloaders[0].is_alive():
-            reloaders.pop(0)
+    await reloaders
 
     logging.info("Reloaders stopped")
 
 
-def register_termination_signals():
-    signal.signal(signal.SIGTERM, terminate)
-    signal.signal(signal.SIGINT, terminate)
-
+def terminate_run(signo, workers):
+    logging.info("Terminating after signal %d", signo)
 
-def terminate(signo, frame):
-    logging.info("terminating after signal %d", signo)
+    # Stop running commands instead of waiting until they complete. Workers
+    # stop their commands when they receive the signal.
     terminated.set()
+    terminate_async_commands()
+    for w in workers:
+        w.terminate()
+
+
+async def wait_for_worker(w):
+    """
+    Wait until worker process terminates. A worker sentinel becomes ready when
+    the worker terminates, so we detect finished workers in any order.
+    """
+    loop = asyncio.get_event_loop()
+    stopped = loop.create_future()
+
+    def sentinel_ready():
+        loop.remove_reader(w.sentinel)
+        stopped.set_result(None)
+
+    loop.add_reader(w.sentinel, sentinel_ready)
+    await stopped
 
+    w.join()
+    logging.info("Worker %s stopped", w.name)
+
+
+def register_worker_signals():
+    # The worker is the main thread of the worker process, so the signal
+    # handler must stop the worker.
+    signal.set_wakeup_fd(-1)
+    signal.signal(signal.SIGTERM, terminate_worker)
+    signal.signal(signal.SIGINT, terminate_worker)
+
+
+def terminate_worker(signo, frame):
+    # Logging here may fail if the signal interrupted the worker while
+    # logging, so the worker logs the signal when it stops.
+    global worker_signal
+    worker_signal = signo
+    terminate_commands()
+
+
+def is_terminated():
+    return worker_signal is not None or terminated.is_set()
+
+
+def track_command(p):
+    with running_commands_lock:
+        running_commands.add(p)
+
+
+def terminate_commands():
+    with running_commands_lock:
+        commands = list(running_commands)
+
+    for p in commands:
+        try:
+            p.terminate()
+        except ProcessLookupError:
+            # Already terminated.
+            pass
+
+
+def terminate_async_commands():
+    """
+    Must be called from the event loop running the commands.
+    """
+    for p in list(running_async_commands):
+        if p.returncode is not None:
+            continue
+        # Process.terminate() polls the process, and may reap it before the
+        # event loop child watcher, so we send the signal ourselves.
+        try:
+            os.kill(p.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            # Already terminated.
+            pass
+
+
+def worker(lvm, args, vg_name, lv_names, start_delay, cpus):
+    # Log the worker name instead of MainThread.
+    threading.current_thread().name = mp.current_process().name
+    register_worker_signals()
+
+    if cpus:
+        os.sched_setaffinity(0, cpus)
 
-def worker(lvm, args, vg_name):
     logging.info("Worker started")
 
+    terminated.wait(start_delay)
+
     for trial in range(1, args.trials + 1):
         logging.info("Starting trial %s/%s", trial, args.trials)
         try:
-            run_trial(lvm, args, vg_name)
+            run_trial(lvm, args, vg_name, lv_names)
         except Terminated:
             logging.info("Trial %s terminated", trial)
             break
@@ -496,47 +704,87 @@ def worker(lvm, args, vg_name):
         else:
             logging.info("Trial %s finished", trial)
 
-    logging.info("Worker finished")
+    lvm.close()
+
+    if worker_signal is not None:
+        logging.info("Worker terminated after signal %d", worker_signal)
+    else:
+        logging.info("Worker finished")
+
+
+def split_cpus():
+    """
+    Split the available cpus to reloaders cpus and workers cpus, so lvm
+    commands run by reloaders and workers do not compete on the same cpus
+    caches.
+    """
+    cpus = sorted(os.sched_getaffinity(0))
+    if len(cpus) < 2:
+        raise RuntimeError("Need at least 2 cpus, have {}".format(cpus))
+
+    half = len(cpus) // 2
+    return set(cpus[:half]), set(cpus[half:])
 
 
-def run_trial(lvm, args, vg_name):
+def run_trial(lvm, args, vg_name, lv_names):
     # Create lvs.
-    for lv_name in iter_lvs(args):
-        lvm.create_lv(vg_name, lv_name)
-        lvm.change_lv_tags(
-            vg_name, lv_name,
-            rem=[TAG_VOL_UNINIT],
-            add=["IU_{}".format(lv_name), "PU_{}".format(BLANK_UUID)])
-        lvm.deactivate_lv(vg_name, lv_name)
+    for batch in iter_lv_batches(lv_names, args.batch_size):
+        lvm.create_lvs(vg_name, batch)
+        lvm.change_lvs_tags(vg_name, [
+            (lv_name,
+             ["IU_{}".format(lv_name), "PU_{}".format(BLANK_UUID)],
+             [TAG_VOL_UNINIT])
+            for lv_name in batch
+        ])
+
+    lvm.deactivate_vg(vg_name)
 
     # Simulate lv usage.
-    for lv_name in iter_lvs(args):
-        lvm.activate_lv(vg_name, lv_name)
+    lvm.activate_vg(vg_name)
+
+    for lv_name in iter_lvs(lv_names):
         perform_io(vg_name, lv_name)
-        lvm.extend_lv(vg_name, lv_name, "+1g")
-        lvm.deactivate_lv(vg_name, lv_name)
+
+    for batch in iter_lv_batches(lv_names, args.batch_size):
+        lvm.extend_lvs(vg_name, batch, "+1g")
+
+    lvm.deactivate_vg(vg_name)
 
     # Prepare lvs for removal.
-    for lv_name in iter_lvs(args):
-        lvm.change_lv_tags(
-            vg_name, lv_name,
-            rem=["IU_{}".format(lv_name)],
-            add=["IU_{}{}".format(REMOVED_IMAGE_PREFIX, lv_name)])
+    for batch in iter_lv_batches(lv_names, args.batch_size):
+        lvm.change_lvs_tags(vg_name, [
+            (lv_name,
+             ["IU_{}{}".format(REMOVED_IMAGE_PREFIX, lv_name)],
+             ["IU_{}".format(lv_name)])
+            for lv_name in batch
+        ])
 
     # Discard and remove lvs.
-    for lv_name in iter_lvs(args):
-        lvm.activate_lv(vg_name, lv_name)
+    lvm.activate_vg(vg_name)
+
+    for lv_name in iter_lvs(lv_names):
         discard_lv(vg_name, lv_name)
-        lvm.deactivate_lv(vg_name, lv_name)
-        lvm.remove_lv(vg_name, lv_name)
+
+    lvm.deactivate_vg(vg_name)
+
+    for batch in iter_lv_batches(lv_names, args.batch_size):
+        lvm.remove_lvs(vg_name, batch)
+
+
+def iter_lvs(lv_names):
+    for lv_name in lv_names:
+        if is_terminated():
+            raise Terminated
+
+        yield lv_name
 
 
-def iter_lvs(args):
-    for i in range(args.lv_count):
-        if terminated.is_set():
+def iter_lv_batches(lv_names, batch_size):
+    for start in range(0, len(lv_names), batch_size):
+        if is_terminated():
             raise Terminated
 
-        yield make_lv_name(i)
+        yield lv_names[start:start + batch_size]
 
 
 def make_delay_name(i):
@@ -562,13 +810,9 @@ def make_lv_name(i):
 class LVMRunner:
 
     def __init__(self, use_udev=True, verbose=0, read_only=False):
-        config = CONFIG_TEMPLATE % {
-            "hints": 'hints="none"' if self.version() == ("2", "03") else "",
-            "use_udev": "1" if use_udev else "0",
-            "locking_type": "4" if read_only else "1",
-        }
-        self.config = config.replace("\n", "")
+        self.config = lvm_config(use_udev, read_only)
         self.verbose = verbose
+        self._local = threading.local()
 
     def create_pv(self, pv_name):
         logging.info("Creating pv %s", pv_name)
@@ -588,67 +832,102 @@ class LVMRunner:
             pv_name
         )
 
-    def create_lv(self, vg_name, lv_name):
-        logging.info("Creating lv %s/%s", vg_name, lv_name)
-        self.run(
-            "lvcreate",
-            "--autobackup", "n",
-            "--contiguous", "n",
-            "--size", "1g",
-            "--addtag", TAG_VOL_UNINIT,
-            "--activate", "y",
-            "--name", lv_name,
-            vg_name
+    def activate_vg(self, vg_name):
+        logging.info("Activating vg %s", vg_name)
+        self.run("vgchange", "--activate", "y", vg_name)
+
+    def deactivate_vg(self, vg_name):
+        logging.info("Deactivating vg %s", vg_name)
+        self.run("vgchange", "--activate", "n", vg_name)
+
+    def create_lvs(self, vg_name, lv_names):
+        logging.info("Creating lvs %s/%s..%s",
+                     vg_name, lv_names[0], lv_names[-1])
+        self.run_script(
+            ("lvcreate",
+             "--autobackup", "n",
+             "--contiguous", "n",
+             "--size", "1g",
+             "--addtag", TAG_VOL_UNINIT,
+             "--activate", "y",
+             "--name", lv_name,
+             vg_name)
+            for lv_name in lv_names
         )
 
-    def activate_lv(self, vg_name, lv_name):
-        logging.info("Activating lv %s/%s", vg_name, lv_name)
-        self.change_lv(vg_name, lv_name, activate="y")
-
-    def deactivate_lv(self, vg_name, lv_name):
-        logging.info("Deactivating lv %s/%s", vg_name, lv_name)
-        self.change_lv(vg_name, lv_name, activate="n")
-
-    def change_lv_tags(self, vg_name, lv_name, add=(), rem=()):
-        logging.info("Changing lv tags %s/%s", vg_name, lv_name)
-        self.change_lv(vg_name, lv_name, add_tags=add, del_tags=rem)
-
-    def change_lv(self, vg_name, lv_name, activate=None, add_tags=(),
-                  del_tags=()):
-        args = ["--autobackup", "n"]
-
-        for tag in add_tags:
-            args.extend(("--addtag", tag))
-
-        for tag in del_tags:
-            args.extend(("--deltag", tag))
-
-        if activate:
-            args.extend(("--activate", activate))
-
-        args.append("{}/{}".format(vg_name, lv_name))
-
-        self.run("lvchange", *args)
-
-    def extend_lv(self, vg_name, lv_name, size):
-        logging.info("Extending lv %s/%s", vg_name, lv_name)
-        self.run(
-            "lvextend",
-            "--autobackup", "n",
-            "--size", size,
-            "{}/{}".format(vg_name, lv_name)
+    def change_lvs_tags(self, vg_name, changes):
+        """
+        Change tags of multiple lvs. changes is a list of (lv_name, add, rem)
+        tuples.
+        """
+        logging.info("Changing lvs tags %s/%s..%s",
+                     vg_name, changes[0][0], changes[-1][0])
+        commands = []
+
+        for lv_name, add_tags, del_tags in changes:
+            cmd = ["lvchange", "--autobackup", "n"]
+
+            for tag in add_tags:
+                cmd.extend(("--addtag", tag))
+
+            for tag in del_tags:
+                cmd.extend(("--deltag", tag))
+
+            cmd.append("{}/{}".format(vg_name, lv_name))
+            commands.append(cmd)
+
+        self.run_script(commands)
+
+    def extend_lvs(self, vg_name, lv_names, size):
+        logging.info("Extending lvs %s/%s..%s",
+                     vg_name, lv_names[0], lv_names[-1])
+        self.run_script(
+            ("lvextend",
+             "--autobackup", "n",
+             "--size", size,
+             "{}/{}".format(vg_name, lv_name))
+            for lv_name in lv_names
         )
 
-    def remove_lv(self, vg_name, lv_name):
-        logging.info("Removing %s/%s", vg_name, lv_name)
-        self.run(
-            "lvremove",
-            "--autobackup", "n",
-            "--force",
-            "{}/{}".format(vg_name, lv_name)
+    def remove_lvs(self, vg_name, lv_names):
+        logging.info("Removing lvs %s/%s..%s",
+                     vg_name, lv_names[0], lv_names[-1])
+        self.run_script(
+            ("lvremove",
+             "--autobackup", "n",
+             "--force",
+             "{}/{}".format(vg_name, lv_name))
+            for lv_name in lv_names
         )
 
     def run(self, cmd_name, *args):
+        return self._shell().run(self._command(cmd_name, *args))
+
+    async def run_async(self, cmd_name, *args, capture=False):
+        return await run_async(self._command(cmd_name, *args), capture=capture)
+
+    def run_script(self, commands):
+        for cmd_name, *args in commands:
+            self.run(cmd_name, *args)
+
+    def close(self):
+        """
+        Terminate the lvm shell of the current thread.
+        """
+        shell = getattr(self._local, "shell", None)
+        if shell:
+            del self._local.shell
+            shell.close()
+
+    def _shell(self):
+        # lvm shell runs one command at a time, so every thread uses its own
+        # shell.
+        shell = getattr(self._local, "shell", None)
+        if shell is None or not shell.alive:
+            shell = self._local.shell = LVMShell()
+        return shell
+
+    def _command(self, cmd_name, *args):
         cmd = [cmd_name, "--config", self.config]
 
         if self.verbose:
@@ -656,145 +935,302 @@ class LVMRunner:
             cmd.append("-" + ("v" * self.verbose))
 
         cmd.extend(args)
-        return run(cmd)
+        return cmd
 
-    def version(self):
-        out = run(["lvm", "version"])
-        for line in out.splitlines():
-            if line.startswith("LVM version:"):
-                #  LVM version:     2.03.09(2) (2020-03-26)
-                _, _, version, date = line.split(None, 3)
-                major, minor, _ = version.split(".")
-                return major, minor
-        raise RuntimeError("Cannot get LVM version")
+
+@functools.lru_cache(maxsize=None)
+def lvm_config(use_udev, read_only):
+    config = CONFIG_TEMPLATE % {
+        "hints": 'hints="none"' if lvm_version() == ("2", "03") else "",
+        "use_udev": "1" if use_udev else "0",
+        "locking_type": "4" if read_only else "1",
+    }
+    return config.replace("\n", "")
+
+
+@functools.lru_cache(maxsize=None)
+def lvm_version():
+    out = run(["lvm", "version"])
+    for line in out.splitlines():
+        if line.startswith("LVM version:"):
+            #  LVM version:     2.03.09(2) (2020-03-26)
+            _, _, version, date = line.split(None, 3)
+            major, minor, _ = version.split(".")
+            return major, minor
+    raise RuntimeError("Cannot get LVM version")
 
 
 def discard_lv(vg_name, lv_name):
     lv_device = "/dev/{}/{}".format(vg_name, lv_name)
     logging.info("Discarding lv %s", lv_device)
-    run(["blkdiscard", "--step", "32m", lv_device])
+    run(["blkdiscard", "--step", "32m", lv_device], capture=False)
 
 
 def perform_io(vg_name, lv_name):
     lv_device = "/dev/{}/{}".format(vg_name, lv_name)
     logging.info("Doing some I/O with %s", lv_device)
 
-    # Write 2 MiB per lv, total 10 GiB per 5000 lvs.
-    run([
-        "dd",
-        "if=/dev/zero",
-        "of=" + lv_device,
-        "bs=64k",
-        "count=32",
-        "oflag=direct",
-    ])
-
-    run([
-        "dd",
-        "if=" + lv_device,
-        "of=/dev/null",
-        "bs=64k",
-        "count=32",
-        "iflag=direct",
-    ])
+    # Direct I/O requires an aligned buffer. mmap buffer is page aligned and
+    # initialized with zeroes. We read back the zeroes we wrote, so we can
+    # reuse the buffer for the next lv.
+    buf = getattr(io_buffers, "buf", None)
+    if buf is None:
+        buf = io_buffers.buf = mmap.mmap(-1, IO_SIZE)
+
+    # os.pwritev() and os.preadv() are not available in python 3.6.
+    fd = os.open(lv_device, os.O_RDWR | os.O_DIRECT)
+    try:
+        os.writev(fd, [buf])
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.readv(fd, [buf])
+    finally:
+        os.close(fd)
+
+
+class LVMShell:
+    """
+    Long running lvm shell, avoiding starting lvm for every command.
+
+    The lvm shell does not report the exit code of a command, so after every
+    command we send an unknown command and read lvm errors until lvm reports
+    the unknown command. A command failed if lvm logged any error.
+    """
+
+    SENTINEL = "__END__"
+
+    def __init__(self):
+        self._proc = subprocess.Popen(
+            ["lvm"],
+            executable=executable("lvm"),
+            close_fds=False,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE)
+        track_command(self._proc)
+
+    @property
+    def alive(self):
+        return self._proc.poll() is None
+
+    def run(self, cmd):
+        logging.debug("Running command %s", cmd)
+
+        script = "{}\n{}\n".format(format_lvm_command(cmd), self.SENTINEL)
+        self._proc.stdin.write(script.encode("utf-8"))
+        self._proc.stdin.flush()
+
+        lines = []
+        while True:
+            line = self._proc.stderr.readline()
+            if not line:
+                rc = self._proc.wait()
+                if is_terminated():
+                    raise Terminated
+                raise Error(cmd, rc, "", "\n".join(lines))
+
+            line = line.decode("utf-8").rstrip()
+            if self.SENTINEL in line:
+                break
+
+            lines.append(line)
+
+        err = "\n".join(lines).strip()
+
+        logging.debug("Command completed err=%r", Head(err))
+
+        if has_lvm_errors(err):
+            raise Error(cmd, ECMD_FAILED, "", err)
+
+    def close(self):
+        try:
+            self._proc.stdin.write(b"exit\n")
+            self._proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        self._proc.wait()
+
+
+def format_lvm_command(cmd):
+    # The lvm shell does not support escaping, but our arguments do not
+    # contain single quotes.
+    return " ".join("'{}'".format(arg) for arg in cmd)
 
 
 class ReloaderStats:
+    """
+    Reload times are kept in nanoseconds.
+    """
 
     def __init__(self):
         self.reloads = 0
         self.errors = 0
         self.failures = 0
-        self.times = []
+        self.times = array.array("q")
+        self.total_time = 0
+        self.min_time = math.inf
+        self.max_time = -math.inf
+
+    def add_time(self, t, count=1):
+        self.times.extend([t] * count)
+        self.total_time += t * count
+        self.min_time = min(self.min_time, t)
+        self.max_time = max(self.max_time, t)
+
+
+async def reload_all(lvm, args, pv_names, vg_names, lv_names):
+    await asyncio.gather(
+        reloader(
+            lvm, args, "pvs",
+            functools.partial(make_pvs_args, args, pv_names)),
+        reloader(
+            lvm, args, "vgs",
+            functools.partial(make_vgs_args, args, vg_names)),
+        reloader(
+            lvm, args, "lvs",
+            functools.partial(make_lvs_args, args, vg_names, lv_names)),
+    )
 
 
-def pv_reloader(lvm, args):
-    logging.info("Reloader started")
+async def reloader(lvm, args, cmd, make_args):
+    logging.info("Reloader %s started", cmd)
     stats = ReloaderStats()
 
+    try:
+        await asyncio.gather(*(
+            reload_loop(lvm, args, cmd, make_args, stats)
+            for _ in range(args.reload_concurrency)
+        ))
+    finally:
+        log_reload_stats(cmd, stats)
+
+
+async def reload_loop(lvm, args, cmd, make_args, stats):
     while not terminated.is_set():
-        pv_number = random.randint(0, args.vg_count - 1)
-        pv_name = make_pv_name(pv_number)
+        try:
+            await reload(lvm, cmd, make_args(), stats, args)
+        except Terminated:
+            break
+        except Exception:
+            # All reloaders run in the same event loop, so an unexpected
+            # error must not end the loop. Count it as a failure, and delay
+            # the next reload in case the error persists (e.g. EMFILE).
+            stats.failures += args.reload_batch
+            logging.exception("Reloading %s failed (%d failures)",
+                              cmd, stats.failures)
+            await asyncio.sleep(1.0)
 
-        logging.info("Reloading pv %s", pv_name)
-        pvs_args = ["--noheadings"]
 
-        if args.use_select:
-            selection = "pv_name = {}".format(pv_name)
-            pvs_args.extend(("--select", selection))
-        else:
-            pvs_args.append(pv_name)
+def make_pvs_args(args, pv_names):
+    batch = random.choices(pv_names, k=args.reload_batch)
 
-        reload(lvm, "pvs", pvs_args, stats, args)
+    if debug_enabled():
+        logging.debug("Reloading pv %s", ", ".join(batch))
 
-    log_reload_stats(stats)
+    pvs_args = report_args(args, "pv_name")
 
+    if args.use_select:
+        selection = any_of(
+            "pv_name = {}".format(pv_name) for pv_name in batch)
+        pvs_args.extend(("--select", selection))
+    else:
+        pvs_args.extend(batch)
 
-def vg_reloader(lvm, args):
-    logging.info("Reloader started")
-    stats = ReloaderStats()
+    return pvs_args
 
-    while not terminated.is_set():
-        vg_number = random.randint(0, args.vg_count - 1)
-        vg_name = make_vg_name(vg_number)
 
-        logging.info("Reloading vg %s", vg_name)
-        vgs_args = ["--noheadings"]
+def make_vgs_args(args, vg_names):
+    batch = random.choices(vg_names, k=args.reload_batch)
 
-        if args.use_select:
-            selection = "vg_name = {}".format(vg_name)
-            vgs_args.extend(("--select", selection))
-        else:
-            vgs_args.append(vg_name)
+    if debug_enabled():
+        logging.debug("Reloading vg %s", ", ".join(batch))
 
-        reload(lvm, "vgs", vgs_args, stats, args)
+    vgs_args = report_args(args, "vg_name")
 
-    log_reload_stats(stats)
+    if args.use_select:
+        selection = any_of(
+            "vg_name = {}".format(vg_name) for vg_name in batch)
+        vgs_args.extend(("--select", selection))
+    else:
+        vgs_args.extend(batch)
 
+    return vgs_args
 
-def lv_reloader(lvm, args):
-    logging.info("Reloader started")
-    stats = ReloaderStats()
 
-    while not terminated.is_set():
-        vg_number = random.randint(0, args.vg_count - 1)
-        vg_name = make_vg_name(vg_number)
+def make_lvs_args(args, vg_names, lv_names):
+    lvs = list(zip(
+        random.choices(vg_names, k=args.reload_batch),
+        random.choices(lv_names, k=args.reload_batch)))
 
-        lv_number = random.randint(0, args.lv_count - 1)
-        lv_name = make_lv_name(lv_number)
+    if debug_enabled():
+        logging.debug(
+            "Reloading lv %s",
+            ", ".join("{}/{}".format(vg_name, lv_name)
+                      for vg_name, lv_name in lvs))
 
-        logging.info("Reloading lv %s/%s", vg_name, lv_name)
-        lvs_args = ["--noheadings"]
+    lvs_args = report_args(args, "vg_name,lv_name")
+
+    if args.use_select:
+        # Select both vg and lv - process metatada of all vgs.
+        selection = any_of(
+            "vg_name = {} && lv_name = {}".format(vg_name, lv_name)
+            for vg_name, lv_name in lvs)
+        lvs_args.extend(("--select", selection))
+    else:
+        # Selecting lv - process metadata of the specified vgs.
+        selection = any_of(
+            "lv_name = {}".format(lv_name) for _, lv_name in lvs)
+        lvs_args.extend(("--select", selection))
+        lvs_args.extend(dict.fromkeys(vg_name for vg_name, _ in lvs))
+
+    return lvs_args
+
+
+def report_args(args, fields):
+    if args.reload_batch > 1:
+        # Report the reloaded items so we can tell which items were found.
+        return ["--reportformat", "json", "--options", fields]
+    return ["--noheadings"]
 
-        if args.use_select:
-            # Select both vg and lv - process metatada of all vgs.
-            selection = "vg_name = {} && lv_name = {}".format(vg_name, lv_name)
-            lvs_args.extend(("--select", selection))
-        else:
-            # Selecting lv - process metadata of the specified vg.
-            selection = "lv_name = {}".format(lv_name)
-            lvs_args.extend(("--select", selection))
-            lvs_args.append(vg_name)
 
-        reload(lvm, "lvs", lvs_args, stats, args)
+def parse_report(cmd, out):
+    """
+    Return the rows of lvm json report:
 
-    log_reload_stats(stats)
+        {"report": [{"lv": [{"vg_name": "vg", "lv_name": "lv"}, ...]}]}
+    """
+    report = json.loads(out)
+    return report["report"][0][cmd[:-1]]
 
 
-def reload(lvm, cmd, cmd_args, stats, args):
+def any_of(selections):
+    """
+    Return lvm selection matching any of selections.
+    """
+    selections = list(selections)
+    if len(selections) == 1:
+        return selections[0]
+    return " || ".join("({})".format(s) for s in selections)
+
+
+async def reload(lvm, cmd, cmd_args, stats, args):
+    # A batched command reloads up to args.reload_batch items. A failed
+    # command is accounted as args.reload_batch reloads, and a successful
+    # command as one reload per reported item.
+    batch = args.reload_batch
+
     delays = [(0.1 * 2**i) for i in range(args.retries)]
     delays.append(0.0)  # no delay after last retry
 
     for attempt, delay in enumerate(delays, 1):
-        stats.reloads += 1
+        start = monotonic_ns()
         try:
-            start = time.monotonic()
-            try:
-                return lvm.run(cmd, *cmd_args)
-            finally:
-                stats.times.append(time.monotonic() - start)
+            out = await lvm.run_async(cmd, *cmd_args, capture=batch > 1)
         except Error as e:
-            stats.errors += 1
+            elapsed = monotonic_ns() - start
+            stats.reloads += batch
+            stats.add_time(elapsed // batch, batch)
+
+            stats.errors += batch
             if args.verbose:
                 filename = "{}-error-{:04}.txt".format(cmd, stats.errors)
                 e.dump(filename)
@@ -802,38 +1238,47 @@ def reload(lvm, cmd, cmd_args, stats, args):
 
             logging.warning("Attempt %d of %d failed: %s",
                             attempt, args.retries + 1, e)
+        else:
+            elapsed = monotonic_ns() - start
 
-    # all attempts have failed
-    stats.failures += 1
-    logging.error("Reloading %s failed (%d failures)", cmd, stats.failures)
+            if batch > 1:
+                rows = parse_report(cmd, out)
+                logging.debug("Reloaded %d of %d items with %s",
+                              len(rows), batch, cmd)
+                # A command reporting no items still counts as a reload.
+                count = max(len(rows), 1)
+            else:
+                count = 1
 
+            stats.reloads += count
+            stats.add_time(elapsed // count, count)
+            return
 
-def log_reload_stats(stats):
-    stats.times.sort()
-    times = stats.times
+    # all attempts have failed
+    stats.failures += batch
+    logging.error("Reloading %s failed (%d failures)", cmd, stats.failures)
 
-    min_time = times[0]
-    max_time = times[-1]
 
-    mid = len(times) // 2
-    if len(times) % 2:
-        med_time = times[mid]
-    else:
-        med_time = (times[mid - 1] + times[mid]) / 2
+def log_reload_stats(cmd, stats):
+    if not stats.times:
+        logging.info("Stats for %s: reloads=0", cmd)
+        return
 
-    avg_time = sum(times) / len(times)
+    avg_time = stats.total_time / len(stats.times) / 1e9
+    med_time = statistics.median(stats.times) / 1e9
 
     logging.info(
-        "Stats: reloads=%s errors=%s error_rate=%.2f%% failures=%s "
+        "Stats for %s: reloads=%s errors=%s error_rate=%.2f%% failures=%s "
         "avg_time=%.3f med_time=%.3f min_time=%.3f max_time=%.3f",
+        cmd,
         stats.reloads,
         stats.errors,
         stats.errors / stats.reloads * 100,
         stats.failures,
         avg_time,
         med_time,
-        min_time,
-        max_time,
+        stats.min_time / 1e9,
+        stats.max_time / 1e9,
     )
 
 
@@ -841,27 +1286,116 @@ def gib(s):
     return int(s) * 1024**3
 
 
-def run(args, input=None):
+def positive_int(s):
+    value = int(s)
+    if value < 1:
+        raise argparse.ArgumentTypeError(
+            "Invalid value {!r}, expecting positive integer".format(s))
+    return value
+
+
+if hasattr(time, "monotonic_ns"):
+    monotonic_ns = time.monotonic_ns
+else:
+    # Python 3.6 does not have time.monotonic_ns().
+    def monotonic_ns():
+        return int(time.monotonic() * 1e9)
+
+
+def run(args, input=None, capture=True):
+    """
+    Run command, returning the output. If capture is False, drop the output
+    and return None; errors are always captured.
+    """
     logging.debug("Running command %s", args)
 
     p = subprocess.Popen(
         args,
+        executable=executable(args[0]),
+        close_fds=False,
         stdin=subprocess.PIPE if input else None,
-        stdout=subprocess.PIPE,
+        stdout=subprocess.PIPE if capture else subprocess.DEVNULL,
         stderr=subprocess.PIPE)
+    track_command(p)
 
     out, err = p.communicate(input=input)
 
-    out = out.decode("utf-8").strip()
-    err = err.decode("utf-8").strip()
+    out = out.decode("utf-8").strip() if capture else ""
+
+    # Errors are needed only for debug logs and failures.
+    if p.returncode != 0 or debug_enabled():
+        err = err.decode("utf-8").strip()
+
+        logging.debug("Command completed rc=%s out=%r err=%r",
+                      p.returncode, Head(out), Head(err))
+
+        if p.returncode != 0:
+            if is_terminated():
+                raise Terminated
+            raise Error(args, p.returncode, out, err)
+
+    return out if capture else None
+
+
+async def run_async(args, capture=False):
+    """
+    Like run(), but the output is dropped unless capture is True.
+    """
+    logging.debug("Running command %s", args)
+
+    p = await asyncio.create_subprocess_exec(
+        *args,
+        executable=executable(args[0]),
+        close_fds=False,
+        stdout=subprocess.PIPE if capture else subprocess.DEVNULL,
+        stderr=subprocess.PIPE)
+    running_async_commands.add(p)
+
+    out, err = await p.communicate()
+
+    out = out.decode("utf-8").strip() if capture else ""
+
+    # Errors are needed only for debug logs and failures.
+    if p.returncode != 0 or debug_enabled():
+        err = err.decode("utf-8").strip()
+
+        logging.debug("Command completed rc=%s out=%r err=%r",
+                      p.returncode, Head(out), Head(err))
+
+        if p.returncode != 0:
+            if is_terminated():
+                raise Terminated
+            raise Error(args, p.returncode, out, err)
+
+    return out if capture else None
+
+
+@functools.lru_cache(maxsize=None)
+def executable(name):
+    """
+    Return the absolute path of executable name.
+
+    subprocess starts commands with posix_spawn() instead of fork() only if
+    the executable is a path and close_fds is False. File descriptors opened
+    by python are not inheritable, but commands inherit file descriptors
+    inherited by this process.
+    """
+    path = shutil.which(name)
+    if path is None:
+        raise FileNotFoundError("No such executable: {!r}".format(name))
+    return path
+
 
-    logging.debug("Command completed rc=%s out=%r err=%r",
-                  p.returncode, Head(out), Head(err))
+def debug_enabled():
+    return logging.getLogger().isEnabledFor(logging.DEBUG)
 
-    if p.returncode != 0:
-        raise Error(args, p.returncode, out, err)
 
-    return out
+def has_lvm_errors(err):
+    for line in err.splitlines():
+        line = line.strip()
+        if line and not line.startswith("WARNING:"):
+            return True
+    return False
 
 
 class Head: